@@ -1,24 +1,108 @@
+import collections
+import functools
+import json
+import threading
+import time
+
 import requests  # For sending POST requests
+from requests.adapters import HTTPAdapter
+
+@functools.lru_cache(maxsize=1024, typed=True)
+def _encode_percentage(percentage):
+    # Hovering revisits the same frames, so reuse their serialized payloads
+    return json.dumps({'percentage': percentage}).encode()
 
 class BabylonCommunicator:
-    def __init__(self, endpoint_url="http://127.0.0.1:5000/send-frame"):
+    def __init__(self, endpoint_url="http://127.0.0.1:5000/send-frame", timeout=2, max_pending=8,
+                 batch_endpoint_url=None, flush_interval=0.05):
         self.endpoint_url = endpoint_url
+        self.timeout = timeout
+
+        # When a batch endpoint (e.g. ".../send-frames") is given, events are buffered for
+        # flush_interval seconds and sent together as {'events': [...]} in a single POST
+        self.batch_endpoint_url = batch_endpoint_url
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque(maxlen=128)
+        self._buffer_lock = threading.Lock()
+        self._flush_timer = None
+
+        # Keep connections alive between requests instead of reconnecting per frame
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=3)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Frame updates are sent from a background thread so the caller never waits
+        # on the server. When the queue is full the oldest pending message is dropped.
+        # The thread is only started on the first send.
+        self._pending = collections.deque(maxlen=max_pending)
+        self._pending_cv = threading.Condition()
+        self._closed = False
+        self._worker = None
 
     def set_endpoint_url(self, endpoint_url):
         self.endpoint_url = endpoint_url
 
-    def send_message_endpoint(self, message, endpoint_url=None):
+    def send_message_endpoint(self, message, endpoint_url=None, parse=True):
         if endpoint_url:
             self.set_endpoint_url(endpoint_url)
+        return self._post(self.endpoint_url, message, parse)
+
+    def _post(self, url, message, parse=True):
+        # Messages may already be serialized to JSON bytes
+        data = message if isinstance(message, bytes) else json.dumps(message).encode()
         try:
-            # Send the message to the Flask server
-            response = requests.post(self.endpoint_url, json=message)
+            # Send the message to the Flask server. The reply is read in full so the
+            # connection goes back to the pool, but only parsed if the caller wants it.
+            response = self.session.post(url, data=data, timeout=self.timeout)
             response.raise_for_status()  # Raise an exception for HTTP errors
+            if not parse:
+                return {"status": "ok"}
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Failed to send message: {e}")
             return {"status": "error", "message": str(e)}
 
+    def _enqueue(self, url, message):
+        with self._pending_cv:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._send_loop, daemon=True)
+                self._worker.start()
+            self._pending.append((url, message))
+            self._pending_cv.notify()
+
+    def _submit(self, event):
+        if self.batch_endpoint_url is None:
+            self._enqueue(self.endpoint_url, event)
+            return
+
+        with self._buffer_lock:
+            self.buffer.append({'t': time.monotonic(), **event})
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_interval, self._flush_buffer)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush_buffer(self):
+        with self._buffer_lock:
+            events = list(self.buffer)
+            self.buffer.clear()
+            self._flush_timer = None
+        if events:
+            self._enqueue(self.batch_endpoint_url, {'events': events})
+
+    def _send_loop(self):
+        while True:
+            with self._pending_cv:
+                while not self._pending and not self._closed:
+                    self._pending_cv.wait()
+                if not self._pending:
+                    return
+                url, message = self._pending.popleft()
+            # Nobody reads the reply of a queued message; failures are reported by _post
+            self._post(url, message, parse=False)
+
     def frame_sender(self, current_frame):
         if current_frame is None:
             print("No frame to send")
@@ -36,7 +120,7 @@ class BabylonCommunicator:
 
         # Send the frame to the Flask server
         frame_data = {'frame': current_frame}
-        print(self.send_message_endpoint(frame_data, self.endpoint_url))
+        self._submit(frame_data)
 
     def percentage_frame_sender(self, percentage):
         if percentage is None:
@@ -50,5 +134,20 @@ class BabylonCommunicator:
         print(f"Sending percentage: {percentage}")
 
         # Send the percentage to the Flask server
-        percentage_data = {'percentage': percentage}
-        print(self.send_message_endpoint(percentage_data, self.endpoint_url))
+        if self.batch_endpoint_url is None:
+            self._enqueue(self.endpoint_url, _encode_percentage(percentage))
+        else:
+            self._submit({'percentage': percentage})
+
+    def close(self):
+        with self._buffer_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+        self._flush_buffer()
+        with self._pending_cv:
+            self._closed = True
+            self._pending_cv.notify()
+        # Don't hang on a stalled server; the worker is a daemon thread
+        if self._worker is not None:
+            self._worker.join(timeout=self.timeout)
+        self.session.close()
@@ -1,4 +1,3 @@
-import math
 import numpy as np
 import matplotlib.pyplot as plt
 import mplcursors
@@ -6,10 +5,63 @@ import pandas as pd
 from mpl_toolkits.mplot3d import Axes3D
 import yaml
 import time
+import threading
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import pyarrow  # noqa: F401  # Faster CSV parsing when available
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
 
 import communicateBabylon as cb
 babylon_communicator = cb.BabylonCommunicator()
 
+
+def _valid_marker_mask(positions, lo, hi, limit):
+    """Return a mask of the (N, 3) positions that are finite, within [lo, hi] and not beyond limit."""
+    finite = np.isfinite(positions).all(axis=1)
+    in_bounds = ((positions >= lo) & (positions <= hi)).all(axis=1)
+    not_extreme = (np.abs(positions) <= limit).all(axis=1)
+    return finite & in_bounds & not_extreme
+
+
+# Copy the markers of an (M, 3) frame that lie within [lo, hi] and whose values do not exceed
+# limit into out_xyz, and return how many were copied. Returns -1 without writing anything if
+# the frame contains NaN or infinite values.
+if njit is not None:
+    @njit(cache=True)
+    def _filter_markers(frame, lo, hi, limit, out_xyz):
+        for i in range(frame.shape[0]):
+            for k in range(3):
+                if not np.isfinite(frame[i, k]):
+                    return -1
+
+        count = 0
+        for i in range(frame.shape[0]):
+            valid = True
+            for k in range(3):
+                v = frame[i, k]
+                if v < lo or v > hi or abs(v) > limit:
+                    valid = False
+            if valid:
+                for k in range(3):
+                    out_xyz[count, k] = frame[i, k]
+                count += 1
+        return count
+else:
+    def _filter_markers(frame, lo, hi, limit, out_xyz):
+        if not np.isfinite(frame).all():
+            return -1
+        mask = _valid_marker_mask(frame, lo, hi, limit)
+        count = int(mask.sum())
+        out_xyz[:count] = frame[mask]
+        return count
+
 class MarkerVisualizer:
     def __init__(self, config_loc, skip_rows=1):
         """Initialize the MarkerVisualizer with a CSV file."""
@@ -18,7 +70,27 @@ class MarkerVisualizer:
         self.fig_3d = None
         self.ax_3d = None
         self.scatter_3d = None
+        self.red_marker_3d = None
+        self._background_3d = None  # Static part of the 3D plot, used for blitting
         self.last_hover_time = 0  # Initialize hover timestamp
+        self.pending_frame = None  # Latest hovered frame waiting to be sent to Babylon
+        self.send_delay = 0.05  # Only the last hover within this window is sent
+        self._pending_cv = threading.Condition()  # Guards pending_frame across the GUI and sender threads
+        self._pending_time = 0  # When pending_frame was last updated
+        self._send_thread = None
+        self._closing = False
+        self._marker_cols = None  # Columns holding X, Y, Z values of all markers
+        self._all_positions = None  # Marker positions as a (frames, markers, 3) array
+        self._selected_marker_idx = None  # Index of the selected marker in _all_positions
+        self._marker_positions = None  # X, Y, Z of the selected marker as a (frames, 3) array
+        self._frames = None  # Sorted frame numbers, used to look up the hovered frame
+        self._stride = 1  # Only every _stride-th frame is drawn in the marker graph
+        self.max_plot_points = 4000  # Roughly the number of points a line needs on screen
+        self._bbox = None  # (min, max) X, Y, Z of all valid marker positions
+        self._valid_buf = None  # Preallocated (markers, 3) buffer for the valid markers of a frame
+        self.position_min, self.position_max = -1000, 10000  # Valid bounds for marker positions
+        # Threshold for extreme values (to avoid floating point errors or outlier positions)
+        self.extreme_threshold = 1e5
 
         # Load the configuration file
         with open(config_loc, "r") as file:
@@ -36,23 +108,63 @@ class MarkerVisualizer:
     #     print(f"Data loaded successfully with {len(self.df)} frames.")
     def load_data(self):
         """Load the marker data from the CSV file."""
-        self.df = pd.read_csv(self.csv_file, skiprows=self.skip_rows)
-        if 'Frame' not in self.df.columns:
+        # Read only the header first, so only the needed columns are parsed
+        header = pd.read_csv(self.csv_file, skiprows=self.skip_rows, nrows=0).columns
+        if 'Frame' not in header:
             raise ValueError("The CSV file must contain a 'Frame' column.")
 
-        # Drop completely empty rows
-        self.df = self.df.dropna(how='all')
-
-        # Drop rows missing critical columns
-        marker_columns = [col for col in self.df.columns if self.marker_name in col]
+        value_columns = [col for col in header if col != 'Frame' and (self.marker_name in col or '<T-' in col)]
+        # The pyarrow engine applies an integer skiprows after the header row, so point it at
+        # the header row directly instead
+        if CSV_ENGINE == "pyarrow":
+            skip = {'header': self.skip_rows}
+        else:
+            skip = {'skiprows': self.skip_rows}
+        self.df = pd.read_csv(
+            self.csv_file,
+            **skip,
+            usecols=['Frame'] + value_columns,
+            dtype={col: np.float32 for col in value_columns},
+            engine=CSV_ENGINE,
+        )
+
+        # Drop rows missing critical columns (this also drops completely empty rows)
+        # and rows with infinite values, in a single pass
+        marker_columns = [col for col in value_columns if self.marker_name in col]
         required_columns = ['Frame'] + marker_columns
-        self.df = self.df.dropna(subset=required_columns)
+        has_required = np.isfinite(self.df[required_columns].to_numpy(dtype=np.float64)).all(axis=1)
+        has_no_inf = ~np.isinf(self.df[value_columns].to_numpy()).any(axis=1)
+        self.df = self.df[has_required & has_no_inf]
 
         # Optional: Fill missing values if required
         self.df = self.df.fillna(0)  # Replace NaN with 0 or interpolate
 
-        # Ensure no infinite values
-        self.df = self.df.replace([np.inf, -np.inf], np.nan).dropna()
+        if len(marker_columns) != 3:
+            raise ValueError(f"Marker '{self.marker_name}' must have exactly 3 columns (X, Y, Z).")
+        self._marker_positions = self.df[marker_columns].to_numpy(dtype=np.float32, copy=False)
+
+        # Cache the positions of all markers once, so hovering only has to index into them
+        self._marker_cols = [col for col in self.df.columns if '<T-' in col]
+        if len(self._marker_cols) % 3 != 0:
+            raise ValueError("Marker columns are not a multiple of 3, invalid structure.")
+        selected = [col for col in self._marker_cols if self.marker_name in col]
+        if len(selected) < 3:
+            raise ValueError(f"Marker '{self.marker_name}' does not have complete X, Y, Z data.")
+        self._all_positions = self.df[self._marker_cols].to_numpy(dtype=np.float32, copy=True).reshape(len(self.df), -1, 3)
+        self._selected_marker_idx = self._marker_cols.index(selected[0]) // 3
+        self._valid_buf = np.empty((self._all_positions.shape[1], 3), dtype=np.float32)
+
+        # Fixed 3D plot limits covering every valid marker position in the recording
+        positions = self._all_positions.reshape(-1, 3)
+        valid = _valid_marker_mask(positions, self.position_min, self.position_max, self.extreme_threshold)
+        if valid.any():
+            self._bbox = (positions[valid].min(axis=0), positions[valid].max(axis=0))
+
+        # Compile the marker filter now rather than on the first hover
+        if len(self._all_positions):
+            _filter_markers(
+                self._all_positions[0], self.position_min, self.position_max, self.extreme_threshold, self._valid_buf
+            )
 
         print(f"Data loaded successfully with {len(self.df)} frames.")
 
@@ -61,19 +173,22 @@ class MarkerVisualizer:
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
-        # Extract the selected marker's columns
-        marker_columns = [col for col in self.df.columns if self.marker_name in col]
-        if len(marker_columns) != 3:
-            raise ValueError(f"Marker '{self.marker_name}' must have exactly 3 columns (X, Y, Z).")
-
         time_stamps = self.df['Frame']
-        marker_positions = self.df[marker_columns].values
+        marker_positions = self._marker_positions
+        self._frames = time_stamps.to_numpy()
+
+        # Decimate long recordings so drawing and hover hit-testing stay cheap; the hovered
+        # position is mapped back to the full frame array in on_add
+        self._stride = max(1, len(time_stamps) // self.max_plot_points)
+        plot_frames = self._frames[::self._stride]
+        plot_positions = marker_positions[::self._stride]
 
         # Plot the position of the selected marker over time (X, Y, Z)
         plt.figure(figsize=(10, 6))
-        x_line, = plt.plot(time_stamps, marker_positions[:, 0], label='X Position')
-        y_line, = plt.plot(time_stamps, marker_positions[:, 1], label='Y Position')
-        z_line, = plt.plot(time_stamps, marker_positions[:, 2], label='Z Position')
+        x_line, = plt.plot(plot_frames, plot_positions[:, 0], label='X Position')
+        y_line, = plt.plot(plot_frames, plot_positions[:, 1], label='Y Position')
+        z_line, = plt.plot(plot_frames, plot_positions[:, 2], label='Z Position')
+        x_line._axis_idx, y_line._axis_idx, z_line._axis_idx = 0, 1, 2  # Column in marker_positions
 
         plt.title(f"Marker {self.marker_name} Position Over Time")
         plt.xlabel("Time (frames)")
@@ -83,11 +198,6 @@ class MarkerVisualizer:
 
         # @cursor.connect("add")
         def on_add(sel):
-            current_time = time.time()
-            if current_time - self.last_hover_time < 0.1:  # Throttle to 100ms
-                return
-            self.last_hover_time = current_time
-
             try:
                 sel.annotation.arrow_patch.set_visible(False)  # Disable the arrow
                 # sel.annotation.arrow_patch.set_connectionstyle("arc3")  # Simpler connection style
@@ -100,26 +210,32 @@ class MarkerVisualizer:
                     return  # Skip invalid targets
 
                 # Ensure the cursor interaction is within plot bounds
-                if sel.target[0] < min(time_stamps) or sel.target[0] > max(time_stamps):
+                if sel.target[0] < self._frames[0] or sel.target[0] > self._frames[-1]:
                     print("Cursor interaction out of bounds.")
                     return
 
                 # Determine the index of the hovered point
-                index = int(np.argmin(np.abs(time_stamps - sel.target[0])))
+                index = self._nearest_frame_index(sel.target[0])
                 if index < 0 or index >= len(time_stamps):
                     print("Index out of bounds:", index)
                     return  # Invalid index, skip update
 
-                # Send the frame data to the Babylon server
+                # Send the frame data to the Babylon server. Only the last hovered frame is
+                # sent once hovering pauses, so this happens before the throttle below.
                 if self.use_babylon:
-                    babylon_communicator.percentage_frame_sender(time_stamps.iloc[index]/len(time_stamps)*100)
+                    self._queue_frame(time_stamps.iloc[index]/len(time_stamps)*100)
+
+                current_time = time.time()
+                if current_time - self.last_hover_time < 0.1:  # Throttle plot updates to 100ms
+                    return
+                self.last_hover_time = current_time
 
                 # Update the 3D plot with the selected marker's position
                 self.update_3d_plot(index)
 
                 # Determine the corresponding value for the hovered point
                 line_label = sel.artist.get_label()
-                position_value = marker_positions[index, {'X Position': 0, 'Y Position': 1, 'Z Position': 2}[line_label]]
+                position_value = marker_positions[index, sel.artist._axis_idx]
 
                 #  Check if position value is finite
                 if not np.isfinite(position_value):
@@ -147,15 +263,76 @@ class MarkerVisualizer:
 
         plt.show()
 
+    def _nearest_frame_index(self, frame):
+        """Return the row index of the frame closest to the given frame number."""
+        index = int(np.searchsorted(self._frames, frame))
+        if index >= len(self._frames):
+            return len(self._frames) - 1
+        if index > 0 and frame - self._frames[index - 1] <= self._frames[index] - frame:
+            return index - 1
+        return index
+
+    def _queue_frame(self, frame):
+        """Make frame the latest hovered frame, to be sent once hovering pauses."""
+        with self._pending_cv:
+            was_empty = self.pending_frame is None
+            self.pending_frame = frame
+            self._pending_time = time.monotonic()
+            if self._send_thread is None:
+                self._send_thread = threading.Thread(target=self._send_pending_frames, daemon=True)
+                self._send_thread.start()
+            if was_empty:
+                self._pending_cv.notify()
+
+    def _send_pending_frames(self):
+        """Send the latest hovered frame to Babylon once no new hover arrived for send_delay."""
+        while True:
+            with self._pending_cv:
+                while self.pending_frame is None and not self._closing:
+                    self._pending_cv.wait()
+                if self.pending_frame is None:
+                    return
+
+                remaining = self._pending_time + self.send_delay - time.monotonic()
+                while remaining > 0 and not self._closing:
+                    self._pending_cv.wait(remaining)
+                    remaining = self._pending_time + self.send_delay - time.monotonic()
+                frame, self.pending_frame = self.pending_frame, None
+            babylon_communicator.percentage_frame_sender(frame)
+
     def create_3d_plot(self):
         """Create the 3D plot for displaying the marker positions."""
         if self.fig_3d is None:
             self.fig_3d = plt.figure(figsize=(8, 6))
-            self.ax_3d = self.fig_3d.add_subplot(111, projection='3d')
+            # Use fixed artist z-orders instead of re-sorting the artists on every redraw
+            self.ax_3d = self.fig_3d.add_subplot(111, projection='3d', computed_zorder=False)
             self.ax_3d.set_xlabel("X-axis")
             self.ax_3d.set_ylabel("Y-axis")
             self.ax_3d.set_zlabel("Z-axis")
             self.ax_3d.set_title("Marker Positions at Selected Frame")
+            if self._bbox is not None:
+                (x_min, y_min, z_min), (x_max, y_max, z_max) = self._bbox
+                self.ax_3d.set_xlim([x_min, x_max])
+                self.ax_3d.set_ylim([y_min, y_max])
+                self.ax_3d.set_zlim([z_min, z_max])
+            self.fig_3d.canvas.mpl_connect('draw_event', self._on_3d_draw)
+
+            # The 2D plot's plt.show() is already blocking, so show this window explicitly
+            self.fig_3d.show()
+
+    def _on_3d_draw(self, event):
+        """Capture the static background after a full redraw and draw the markers on top."""
+        if not self.fig_3d.canvas.supports_blit:
+            return
+        self._background_3d = self.fig_3d.canvas.copy_from_bbox(self.ax_3d.bbox)
+        self._draw_3d_markers()
+
+    def _draw_3d_markers(self):
+        """Draw the animated marker scatters onto the 3D canvas."""
+        for artist in (self.scatter_3d, self.red_marker_3d):
+            if artist is not None:
+                artist.do_3d_projection()
+                self.ax_3d.draw_artist(artist)
 
     def update_3d_plot(self, frame_index):
         """Update the existing 3D plot with all markers and highlight the selected one."""
@@ -168,108 +345,65 @@ class MarkerVisualizer:
             # Ensure the 3D figure is initialized
             self.create_3d_plot()
 
-            # Extract all marker columns
-            marker_columns = [col for col in self.df.columns if '<T-' in col]
-            if len(marker_columns) % 3 != 0:
-                print("Marker columns are not a multiple of 3, invalid structure.")
-                return
-            
-            # Reshape to (frames, markers, 3)
-            all_marker_positions = self.df[marker_columns].values.reshape(-1, len(marker_columns) // 3, 3)
+            frame_positions = self._all_positions[frame_index]
 
-            # Validate marker positions for the frame
-            if frame_index >= len(all_marker_positions):
-                print(f"Invalid frame index: {frame_index} exceeds available frames.")
-                return
-            frame_positions = all_marker_positions[frame_index]
-
-            # Handle NaN or infinite values in the frame data
-            if not np.isfinite(frame_positions).all():
+            # Filter out markers outside the bounds, skipping frames with NaN or infinite values
+            count = _filter_markers(
+                frame_positions, self.position_min, self.position_max, self.extreme_threshold, self._valid_buf
+            )
+            if count < 0:
                 print(f"Frame {frame_index} contains invalid marker positions.")
                 return
-            
-            # Define valid bounds for marker positions
-            position_min, position_max = -1000, 10000  # Adjust these bounds as needed
-            valid_marker_positions = []
-            
-            # Threshold for extreme values (to avoid floating point errors or outlier positions)
-            extreme_threshold_min = -1e5  # Minimum threshold (e.g., -100,000)
-            extreme_threshold_max = 1e5   # Maximum threshold (e.g., 100,000)
-            
-            # Filter out markers outside the bounds and non-finite values
-            for i, pos in enumerate(frame_positions):
-                # Check if any of the values in the position are NaN or Inf
-                if any(math.isnan(val) or math.isinf(val) for val in pos):
-                    print(f"Skipping marker at index {i} with position {pos} (NaN or Inf values).")
-                    continue  # Skip this marker
-
-                # Ensure position is within bounds and not too extreme
-                if np.all((pos >= position_min) & (pos <= position_max)):
-                    # Check for extreme values
-                    if np.all((pos >= extreme_threshold_min) & (pos <= extreme_threshold_max)):
-                        # Marker passes all checks, add it to valid list
-                        valid_marker_positions.append(pos)
-                    else:
-                        print(f"Skipping marker at index {i} with position {pos} (extreme values).")
-                else:
-                    print(f"Skipping marker at index {i} with position {pos} (out of bounds).")
+            valid_marker_positions = self._valid_buf[:count]
+
+            skipped = len(frame_positions) - count
+            if skipped:
+                print(f"Skipped {skipped} of {len(frame_positions)} markers in frame {frame_index}.")
 
             # Skip if no valid markers are found
-            if not valid_marker_positions:
+            if count == 0:
                 print(f"No valid markers found for frame {frame_index}.")
                 return
 
             # Get the position of the selected marker
-            marker_columns_selected = [col for col in self.df.columns if self.marker_name in col]
-            if len(marker_columns_selected) < 3:
-                print(f"Marker '{self.marker_name}' does not have complete X, Y, Z data.")
-                return
-            selected_marker_idx = marker_columns.index(marker_columns_selected[0]) // 3
-            valid_selected_marker = frame_positions[selected_marker_idx]
-
-            # Clear the previous scatter plot
-            if self.scatter_3d:
-                self.scatter_3d.remove()
-
-            # Plot all valid markers in blue
-            valid_marker_positions = np.array(valid_marker_positions)
-
-            # Check if all valid_marker_positions are finite
-            if not np.all(np.isfinite(valid_marker_positions)):
-                print("There are still non-finite values in valid_marker_positions.")
-                return
-
-            self.scatter_3d = self.ax_3d.scatter(
-                valid_marker_positions[:, 0], valid_marker_positions[:, 1], valid_marker_positions[:, 2],
-                c='blue', s=20, label="All Markers"
-            )
+            valid_selected_marker = frame_positions[self._selected_marker_idx]
 
-            # Remove the previous red marker (if any)
-            if hasattr(self, 'red_marker_3d') and self.red_marker_3d:
-                self.red_marker_3d.remove()
-
-            # Highlight the selected marker in red
-            if np.isfinite(valid_selected_marker).all():  # Check if selected marker is valid
+            x_vals = valid_marker_positions[:, 0]
+            y_vals = valid_marker_positions[:, 1]
+            z_vals = valid_marker_positions[:, 2]
+            canvas = self.fig_3d.canvas
+
+            if self.scatter_3d is None:
+                # Plot all valid markers in blue and highlight the selected marker in red.
+                # When blitting is available both are animated, so they can be redrawn
+                # without redrawing the axes; otherwise they are drawn with the figure.
+                animated = canvas.supports_blit
+                self.scatter_3d = self.ax_3d.scatter(
+                    x_vals, y_vals, z_vals,
+                    c='blue', s=20, label="All Markers", animated=animated, zorder=1
+                )
                 self.red_marker_3d = self.ax_3d.scatter(
                     valid_selected_marker[0], valid_selected_marker[1], valid_selected_marker[2],
-                    c='red', s=100, label="Selected Marker"
+                    c='red', s=100, label="Selected Marker", animated=animated, zorder=10
                 )
 
-            # Dynamically adjust plot limits based on valid marker positions
-            x_vals = valid_marker_positions[:, 0]
-            y_vals = valid_marker_positions[:, 1]
-            z_vals = valid_marker_positions[:, 2]
-            
-            # Set axis limits to fit the valid marker positions
-            self.ax_3d.set_xlim([x_vals.min(), x_vals.max()])
-            self.ax_3d.set_ylim([y_vals.min(), y_vals.max()])
-            self.ax_3d.set_zlim([z_vals.min(), z_vals.max()])
-
-            # Update the plot without adding duplicate legends
-            self.ax_3d.legend(loc='upper right')
-            self.ax_3d.figure.canvas.draw_idle()
-            self.ax_3d.figure.canvas.flush_events()
-            plt.pause(0.01)  # Brief pause to allow the plot to update
+                self.ax_3d.legend(loc='upper right')
+                canvas.draw_idle()
+            else:
+                # Move the existing markers instead of recreating them
+                self.scatter_3d._offsets3d = (x_vals, y_vals, z_vals)
+                self.red_marker_3d._offsets3d = (
+                    [valid_selected_marker[0]], [valid_selected_marker[1]], [valid_selected_marker[2]]
+                )
+
+                if self._background_3d is None:
+                    canvas.draw_idle()
+                else:
+                    canvas.restore_region(self._background_3d)
+                    self._draw_3d_markers()
+                    canvas.blit(self.ax_3d.bbox)
+
+            canvas.flush_events()
 
         except Exception as e:
             print(f"Error in update_3d_plot: {e}")
@@ -279,6 +413,15 @@ class MarkerVisualizer:
         if self.fig_3d is not None:
             plt.show()
 
+    def close(self):
+        """Send the last hovered frame and release the connection to the Babylon server."""
+        with self._pending_cv:
+            self._closing = True
+            self._pending_cv.notify()
+        if self._send_thread is not None:
+            self._send_thread.join(timeout=1)
+        babylon_communicator.close()
+
 
 # Example usage
 if __name__ == "__main__":
@@ -291,6 +434,8 @@ if __name__ == "__main__":
     # Keep the 3D plot open
     visualizer.show_3d_plot()
 
+    visualizer.close()
+
 # # Example usage
 # if __name__ == "__main__":
 #     visualizer = MarkerVisualizer("config.yaml")